@@ -0,0 +1,46 @@
+import pytest
+import numpy as np
+
+pytest.importorskip("numba")
+
+from image_processing_nb import largest_cc_label
+
+
+def test_largest_cc_label_correct():
+    """
+    Test that the largest 4-connected region of the label is written into the output buffer.
+
+    GIVEN: A 2D mask with two regions of label 1 and one of label 2.
+    WHEN: The largest_cc_label function is called for label 1.
+    THEN: It returns the area of the region and the buffer holds only the largest region of label 1.
+    """
+    mask = np.array([[1, 1, 0, 2],
+                     [1, 0, 0, 2],
+                     [0, 1, 1, 2],
+                     [0, 1, 1, 2]])
+    out = np.full_like(mask, 7)
+
+    area = largest_cc_label(mask, 1, out)
+
+    expected = np.array([[0, 0, 0, 0],
+                         [0, 0, 0, 0],
+                         [0, 1, 1, 0],
+                         [0, 1, 1, 0]])
+    assert area == 4 and np.array_equal(out, expected), f"Expected largest region {expected}, but got {out}"
+
+
+def test_largest_cc_label_not_found():
+    """
+    Test that the function reports a missing label without touching the output buffer.
+
+    GIVEN: A 2D mask that does not contain the label.
+    WHEN: The largest_cc_label function is called.
+    THEN: It returns an area of 0 and the buffer is left unchanged.
+    """
+    mask = np.array([[2, 2],
+                     [0, 3]])
+    out = np.full_like(mask, 7)
+
+    area = largest_cc_label(mask, 1, out)
+
+    assert area == 0 and (out == 7).all(), "The output buffer should be untouched when the label is not found."
@@ -1,3 +1,4 @@
+import threading
 import pytest
 import numpy as np
 import SimpleITK as sitk
@@ -5,6 +6,20 @@ from unittest.mock import patch
 from image_processing import *
 
 
+# Shared 3-slice, 4x4 image and mask volumes (labels 1 and 2) for the get_slices_2D tests
+_IMG3 = np.zeros((3, 4, 4), dtype=np.float32)
+_MASK3 = np.array([
+    [[0, 1, 1, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
+    [[0, 0, 0, 0], [1, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
+    [[2, 2, 0, 0], [2, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
+], dtype=np.uint8)
+
+
+def _eq(a, b):
+    """Compare two integer masks with a fused xor + any reduction instead of np.array_equal."""
+    return a.shape == b.shape and a.dtype == b.dtype and not np.bitwise_xor(a, b).any()
+
+
 def test_extract_largest_region_correct():
     """
     Test the correct behavior of the extract_largest_region function.
@@ -27,7 +42,58 @@ def test_extract_largest_region_correct():
                          [0, 0, 0, 0]])
 
     # Assert the largest region is correctly extracted
-    assert np.array_equal(largest_region, expected), f"Expected largest region {expected}, but got {largest_region}"
+    assert _eq(largest_region, expected), f"Expected largest region {expected}, but got {largest_region}"
+
+
+def test_extract_largest_region_out_buffer():
+    """
+    Test that the result is written into the preallocated buffer when one is given.
+
+    GIVEN: A 2D mask with two regions of a specified label and a preallocated output buffer.
+    WHEN: The extract_largest_region function is called with the out argument.
+    THEN: The function returns the same buffer, filled with the largest connected region.
+    """
+    mask = np.array([[1, 1, 0, 0],
+                     [1, 1, 0, 0],
+                     [1, 0, 1, 1],
+                     [0, 0, 1, 1]])
+    out = np.full_like(mask, 7)
+
+    largest_region = extract_largest_region(mask, 1, out=out)
+
+    expected = np.array([[1, 1, 0, 0],
+                         [1, 1, 0, 0],
+                         [1, 0, 0, 0],
+                         [0, 0, 0, 0]])
+
+    assert largest_region is out, "Expected the result to be written into the given buffer."
+    assert _eq(largest_region, expected), f"Expected largest region {expected}, but got {largest_region}"
+
+
+def test_extract_largest_region_scipy_backend(monkeypatch):
+    """
+    Test the scipy search of extract_largest_region, used when neither numba nor OpenCV is installed.
+
+    GIVEN: numba and OpenCV are not available and a slice with two labels.
+    WHEN: The extract_largest_region function is called for each label.
+    THEN: Each call returns the largest region of its own label.
+    """
+    monkeypatch.setattr("image_processing.largest_cc_label", None)
+    monkeypatch.setattr("image_processing.cv2", None)
+    mask = np.array([[1, 1, 0, 2],
+                     [1, 0, 0, 2],
+                     [0, 1, 1, 2],
+                     [0, 1, 1, 0]])
+
+    region_1 = extract_largest_region(mask, 1)
+    region_2 = extract_largest_region(mask, 2)
+
+    expected_1 = np.array([[0, 0, 0, 0],
+                           [0, 0, 0, 0],
+                           [0, 1, 1, 0],
+                           [0, 1, 1, 0]])
+    assert _eq(region_1, expected_1), f"Unexpected region for label 1: {region_1}"
+    assert _eq(region_2, np.where(mask == 2, 2, 0)), f"Unexpected region for label 2: {region_2}"
 
 
 def test_extract_largest_region_negative_label():
@@ -44,10 +110,8 @@ def test_extract_largest_region_negative_label():
                      [0, 0, 1, 1]])  # Valid mask slice
     label_value = -1  # Invalid label value
 
-    try:
+    with pytest.raises(ValueError, match="Label value cannot be negative"):
         extract_largest_region(mask_slice, label_value)
-    except ValueError as e:
-        assert str(e) == "Label value cannot be negative", "Error message does not match."
 
 
 def test_extract_largest_region_label_not_found():
@@ -97,8 +161,7 @@ def test_extract_largest_region_found():
         [0, 0, 0, 0, 0]
     ], dtype=int)
 
-    assert np.array_equal(result,
-                          expected_result), "The function should extract the largest connected region for label 1."
+    assert _eq(result, expected_result), "The function should extract the largest connected region for label 1."
 
 
 def test_extract_largest_region_swapped_inputs():
@@ -112,46 +175,26 @@ def test_extract_largest_region_swapped_inputs():
     mask_slice = 1  # Incorrect: should be a numpy array
     label_value = np.array([[0, 1], [1, 0]])  # Incorrect: should be an integer
 
-    try:
+    with pytest.raises(TypeError, match="Inputs appear to be swapped. Expected mask_slice as a numpy array and "
+                                        "label_value as an integer."):
         extract_largest_region(mask_slice, label_value)
-    except TypeError as e:
-        assert str(e) == "Inputs appear to be swapped. Expected mask_slice as a numpy array and label_value as an integer.", \
-            "Error message does not match."
 
 
-def test_extract_largest_region_label_not_float():
+@pytest.mark.parametrize("label_value", [1.5, "label"])
+def test_extract_largest_region_label_not_integer(label_value):
     """
-    Test that the function raises a TypeError if label_value is a float.
+    Test that the function raises a TypeError if label_value is not an integer.
 
-    GIVEN: A float label value.
+    GIVEN: A float or string label value.
     WHEN: The extract_largest_region function is called.
     THEN: The function should raise a TypeError indicating that the label value must be an integer.
     """
     mask_slice = np.zeros((5, 5), dtype=int)  # Example empty mask slice
 
-    # Test with a float as label_value
-    label_value = 1.5
     with pytest.raises(TypeError, match="Label value must be an integer"):
         extract_largest_region(mask_slice, label_value)
 
 
-def test_extract_largest_region_label_not_string():
-    """
-    Test that the function raises a TypeError if label_value is a string.
-
-    GIVEN: A string label value.
-    WHEN: The extract_largest_region function is called.
-    THEN: The function should raise a TypeError indicating that the label value must be an integer.
-    """
-    mask_slice = np.zeros((5, 5), dtype=int)  # Example empty mask slice
-
-    # Test with a string as label_value
-    label_value = "label"
-    with pytest.raises(TypeError, match="Label value must be an integer"):
-        extract_largest_region(mask_slice, label_value)
-
-
-
 def test_process_slice_single_label():
     """
     Test process_slice with a mask containing a single labeled region.
@@ -191,9 +234,8 @@ def test_process_slice_single_mask():
         [0, 1, 1, 0],
         [0, 1, 1, 0],
         [0, 0, 0, 0]
-    ])
-    assert np.array_equal(largest_region_mask,
-                          expected_region_mask), "The largest region mask does not match the expected result."
+    ], dtype=np.uint8)
+    assert _eq(largest_region_mask, expected_region_mask), "The largest region mask does not match the expected result."
 
 
 def test_process_slice_multiple_labels_label():
@@ -235,20 +277,150 @@ def test_process_slice_multiple_labels_mask():
         [0, 1, 1, 0, 0, 0, 0],
         [0, 1, 1, 0, 0, 0, 0],
         [0, 0, 0, 0, 0, 0, 0]
-    ])
+    ], dtype=np.uint8)
 
     expected_region_mask_2 = np.array([
         [0, 0, 0, 0, 2, 2, 2],
         [0, 0, 0, 0, 2, 2, 2],
         [0, 0, 0, 0, 0, 0, 0]
-    ])
+    ], dtype=np.uint8)
 
     # Assert that the largest region mask matches the expected result based on the label
-    assert np.array_equal(largest_region_mask, expected_region_mask_1) or np.array_equal(largest_region_mask,
-                                                                                         expected_region_mask_2), \
+    assert _eq(largest_region_mask, expected_region_mask_1) or _eq(largest_region_mask, expected_region_mask_2), \
         f"Unexpected largest region mask for label {label}."
 
 
+@pytest.mark.parametrize("mask_slice, expected_label, expected_region_mask", [
+    # The merged component of labels 1 and 2 is the largest one: label 1 holds the largest region
+    (np.array([[2, 1, 1, 1, 1, 0, 3, 3, 3],
+               [0, 1, 1, 1, 1, 0, 3, 3, 3],
+               [0, 1, 1, 0, 0, 0, 3, 3, 3]]),
+     1,
+     np.array([[0, 1, 1, 1, 1, 0, 0, 0, 0],
+               [0, 1, 1, 1, 1, 0, 0, 0, 0],
+               [0, 1, 1, 0, 0, 0, 0, 0, 0]])),
+    # Touching regions of labels 1 and 2 of the same area: the smaller label wins the tie
+    (np.array([[1, 1, 2, 2, 2],
+               [1, 1, 2, 0, 0],
+               [0, 0, 0, 0, 0]]),
+     1,
+     np.array([[1, 1, 0, 0, 0],
+               [1, 1, 0, 0, 0],
+               [0, 0, 0, 0, 0]])),
+    # Label 3 touches a larger region of label 2 that is split in two by it
+    (np.array([[2, 2, 3, 2, 2, 2],
+               [2, 2, 3, 2, 2, 2],
+               [0, 0, 0, 0, 0, 0]]),
+     2,
+     np.array([[0, 0, 0, 2, 2, 2],
+               [0, 0, 0, 2, 2, 2],
+               [0, 0, 0, 0, 0, 0]])),
+])
+def test_process_slice_touching_labels_mask(mask_slice, expected_label, expected_region_mask):
+    """
+    Test that touching regions with different labels are not merged into a single region.
+
+    GIVEN: A mask slice where regions of different labels touch.
+    WHEN: The process_slice function is called.
+    THEN: It should return the largest single-label region and its label.
+    """
+    largest_region_mask, label = process_slice(mask_slice)
+
+    assert label == expected_label, f"Expected label {expected_label}, but got {label}."
+    assert _eq(largest_region_mask, expected_region_mask.astype(np.uint8)), \
+        f"Expected largest region {expected_region_mask}, but got {largest_region_mask}."
+
+
+@pytest.mark.parametrize("mask_slice, expected_label, expected_area", [
+    # Label 1 has more pixels, but split in two regions smaller than the region of label 2
+    (np.array([[1, 1, 1, 0, 1, 1, 1],
+               [0, 0, 0, 0, 0, 0, 0],
+               [2, 2, 2, 2, 0, 0, 0]]), 2, 4),
+    # Label 3 has more pixels, but its largest region only ties with the single region of label 1
+    (np.array([[3, 3, 3, 0, 3, 3, 3],
+               [3, 3, 0, 0, 0, 3, 3],
+               [0, 0, 0, 0, 0, 0, 0],
+               [1, 1, 1, 1, 1, 0, 0]]), 1, 5),
+])
+def test_process_slice_selection_rule(mask_slice, expected_label, expected_area):
+    """
+    Test that the region is chosen by its own area, not by the pixel count of its label.
+
+    GIVEN: A mask slice where the label with the most pixels does not hold the largest region.
+    WHEN: The process_slice function is called.
+    THEN: It should return the largest single-label region, the smaller label winning ties.
+    """
+    largest_region_mask, label = process_slice(mask_slice)
+
+    assert label == expected_label, f"Expected label {expected_label}, but got {label}."
+    assert np.count_nonzero(largest_region_mask) == expected_area, \
+        f"Expected a region of {expected_area} pixels, but got {np.count_nonzero(largest_region_mask)}."
+    assert (largest_region_mask[largest_region_mask != 0] == expected_label).all(), "Region holds other labels."
+
+
+@pytest.mark.parametrize("mask_slice, expected_label, expected_region_mask", [
+    (np.array([[2, 1, 1, 1, 1, 0, 3, 3, 3],
+               [0, 1, 1, 1, 1, 0, 3, 3, 3],
+               [0, 1, 1, 0, 0, 0, 3, 3, 3]]),
+     1,
+     np.array([[0, 1, 1, 1, 1, 0, 0, 0, 0],
+               [0, 1, 1, 1, 1, 0, 0, 0, 0],
+               [0, 1, 1, 0, 0, 0, 0, 0, 0]])),
+    (np.array([[0, 2, 0, 0],
+               [0, 0, 2, 2],
+               [0, 0, 2, 2]]),
+     2,
+     np.array([[0, 0, 0, 0],
+               [0, 0, 2, 2],
+               [0, 0, 2, 2]])),
+])
+def test_process_slice_scipy_backend(monkeypatch, mask_slice, expected_label, expected_region_mask):
+    """
+    Test the scipy labelling of process_slice, used when neither numba nor OpenCV is installed.
+
+    GIVEN: numba and OpenCV are not available and a mask slice with several regions.
+    WHEN: The process_slice function is called.
+    THEN: It should return the largest single-label region and its label.
+    """
+    monkeypatch.setattr("image_processing.largest_cc_label", None)
+    monkeypatch.setattr("image_processing.cv2", None)
+
+    largest_region_mask, label = process_slice(mask_slice)
+
+    assert label == expected_label, f"Expected label {expected_label}, but got {label}."
+    assert _eq(largest_region_mask, expected_region_mask.astype(np.uint8)), \
+        f"Expected largest region {expected_region_mask}, but got {largest_region_mask}."
+
+
+@pytest.mark.parametrize("backend", ["numba", "opencv", "scipy"])
+def test_process_slice_backends_agree(monkeypatch, backend):
+    """
+    Test that every labelling backend selects the same region as the scipy one.
+
+    GIVEN: Random mask slices with touching labels, and one of the optional backends.
+    WHEN: The process_slice function is called with that backend and with scipy.
+    THEN: Both calls should return the same label and region mask.
+    """
+    if backend == "numba" and largest_cc_label is None:
+        pytest.skip("numba is not installed")
+    if backend != "numba":
+        monkeypatch.setattr("image_processing.largest_cc_label", None)
+    if backend == "opencv" and cv2 is None:
+        pytest.skip("OpenCV is not installed")
+    rng = np.random.default_rng(0)
+    slices = [rng.choice(4, size=(12, 12), p=[0.4, 0.2, 0.2, 0.2]).astype(np.uint8) for _ in range(50)]
+
+    results = [process_slice(mask_slice) for mask_slice in slices]
+    monkeypatch.setattr("image_processing.largest_cc_label", None)
+    monkeypatch.setattr("image_processing.cv2", None)
+    expected = [process_slice(mask_slice) for mask_slice in slices]
+
+    assert all(
+        label == expected_label and _eq(region, expected_region)
+        for (region, label), (expected_region, expected_label) in zip(results, expected)
+    ), f"The {backend} backend selects different regions than scipy."
+
+
 def test_process_slice_returns_none_none():
     """
     GIVEN a mask slice with no labeled regions (all zeros)
@@ -265,143 +437,154 @@ def test_process_slice_returns_none_none():
     assert (region_mask, label) == (None, None), f"Expected (None, None), but got ({region_mask}, {label})"
 
 
-def test_get_slices_2D_valid_length():
+@pytest.fixture(scope="session")
+def sample_3d_image_mask():
     """
-    Test that get_slices_2D returns the expected number of slices for a valid input.
+    Provide a valid 3-slice image and mask shared by the whole test session.
 
-    GIVEN: A valid image and mask.
-    WHEN: The function get_slices_2D is called.
-    THEN: It should return a list with the correct number of slices.
+    GIVEN: A 3x4x4 float32 image and a mask with labels 1 and 2.
+    WHEN: The fixture is requested.
+    THEN: It returns both volumes as SimpleITK Images.
     """
-    image_array = np.random.rand(3, 4, 4)  # 3 slices, 4x4 pixels
-    mask_array = np.array([  # 3 slices, label 1 and 2
-        [[0, 1, 1, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[0, 0, 0, 0], [1, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[2, 2, 0, 0], [2, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
-    ])
-    image = sitk.GetImageFromArray(image_array)
-    mask = sitk.GetImageFromArray(mask_array)
-    patient_id = 1234
+    return sitk.GetImageFromArray(_IMG3), sitk.GetImageFromArray(_MASK3)
 
-    slices = get_slices_2D(image, mask, patient_id)
 
-    assert len(slices) == 3, f"Expected 3 slices, but got {len(slices)}."
+@pytest.fixture(scope="session")
+def empty_sitk_10():
+    """Provide an empty 10x10x10 SimpleITK Image shared by the whole test session."""
+    return sitk.Image(10, 10, 10, sitk.sitkUInt8)
 
 
-def test_get_slices_2D_patient_id():
+@pytest.fixture(scope="module")
+def slices_2d_result(sample_3d_image_mask):
     """
-    Test that the PatientID is correctly set in the slice data.
+    Build the slices of a valid 3-slice image and mask once for the whole module.
 
-    GIVEN: A valid image, mask, and PatientID.
+    GIVEN: A valid image and mask with labels 1 and 2.
     WHEN: The function get_slices_2D is called.
-    THEN: The PatientID should be included correctly in each slice data.
+    THEN: The returned slices are shared by the get_slices_2D tests.
     """
-    image_array = np.random.rand(3, 4, 4)
-    mask_array = np.array([  # 3 slices
-        [[0, 1, 1, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[0, 0, 0, 0], [1, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[2, 2, 0, 0], [2, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
-    ])
-    image = sitk.GetImageFromArray(image_array)
-    mask = sitk.GetImageFromArray(mask_array)
+    image, mask = sample_3d_image_mask
     patient_id = 1234
 
-    slices = get_slices_2D(image, mask, patient_id)
+    return get_slices_2D(image, mask, patient_id)
 
-    assert slices[0]['PatientID'] == f"PR{patient_id}", f"Expected PatientID 'PR{patient_id}', but got {slices[0]['PatientID']}."
 
+def test_get_slices_2D_valid_length(slices_2d_result):
+    """
+    Test that get_slices_2D returns the expected number of slices for a valid input.
 
-def test_get_slices_2D_slice_index():
+    GIVEN: A valid image and mask.
+    WHEN: The function get_slices_2D is called.
+    THEN: It should return a batch with the correct number of slices.
     """
-    Test that the SliceIndex is correctly set in the slice data.
+    assert len(slices_2d_result) == 3, f"Expected 3 slices, but got {len(slices_2d_result)}."
 
-    GIVEN: A valid image, mask, and PatientID.
+
+def test_get_slices_2D_columns(slices_2d_result):
+    """
+    Test that the slice indices and labels are stored as numpy columns.
+
+    GIVEN: A valid image and mask.
     WHEN: The function get_slices_2D is called.
-    THEN: The SliceIndex should be correctly set for each slice.
+    THEN: The returned batch should hold one slice index and one label per slice.
     """
-    image_array = np.random.rand(3, 4, 4)
-    mask_array = np.array([  # 3 slices
-        [[0, 1, 1, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[0, 0, 0, 0], [1, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[2, 2, 0, 0], [2, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
-    ])
-    image = sitk.GetImageFromArray(image_array)
-    mask = sitk.GetImageFromArray(mask_array)
-    patient_id = 1234
+    assert isinstance(slices_2d_result, SlicesBatch), f"Expected a SlicesBatch, but got {type(slices_2d_result)}."
+    assert slices_2d_result.indices.tolist() == [0, 1, 2], f"Unexpected slice indices {slices_2d_result.indices}."
+    assert slices_2d_result.labels.tolist() == [1, 1, 2], f"Unexpected labels {slices_2d_result.labels}."
+
+
+def test_slices_batch_equality(slices_2d_result):
+    """
+    Test that comparing batches does not compare their numpy columns.
 
-    slices = get_slices_2D(image, mask, patient_id)
+    GIVEN: A batch returned by get_slices_2D.
+    WHEN: It is compared with itself and with a batch holding copies of its columns.
+    THEN: The comparison uses identity and does not raise.
+    """
+    copy = SlicesBatch(**{**vars(slices_2d_result), "indices": slices_2d_result.indices.copy(),
+                          "labels": slices_2d_result.labels.copy()})
 
-    assert slices[1]['SliceIndex'] == 1, f"Expected slice index 1, but got {slices[1]['SliceIndex']}."
+    assert slices_2d_result == slices_2d_result and slices_2d_result != copy, "Batches should compare by identity."
 
 
-def test_get_slices_2D_image_slice():
+@pytest.mark.parametrize("idx, key, expected", [
+    (0, 'PatientID', "PR1234"),
+    (1, 'SliceIndex', 1),
+    (0, 'Label', 1),
+])
+def test_get_slices_2D_values(slices_2d_result, idx, key, expected):
     """
-    Test that the image slice is correctly converted into a SimpleITK Image.
+    Test that PatientID, SliceIndex and Label are correctly set in the slice data.
 
-    GIVEN: A valid image and mask.
+    GIVEN: A valid image, mask, and PatientID.
     WHEN: The function get_slices_2D is called.
-    THEN: The 'ImageSlice' in the returned data should be a SimpleITK Image.
+    THEN: Each field should hold the expected value for the given slice.
     """
-    image_array = np.random.rand(3, 4, 4)
-    mask_array = np.array([  # 3 slices
-        [[0, 1, 1, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[0, 0, 0, 0], [1, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[2, 2, 0, 0], [2, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
-    ])
-    image = sitk.GetImageFromArray(image_array)
-    mask = sitk.GetImageFromArray(mask_array)
-    patient_id = 1234
+    assert slices_2d_result[idx][key] == expected, \
+        f"Expected {key} {expected!r} for slice {idx}, but got {slices_2d_result[idx][key]!r}."
 
-    slices = get_slices_2D(image, mask, patient_id)
 
-    assert isinstance(slices[0]['ImageSlice'], sitk.Image), "Expected 'ImageSlice' to be a SimpleITK Image."
+@pytest.mark.parametrize("key", ['ImageSlice', 'MaskSlice'])
+def test_get_slices_2D_sitk_slices(slices_2d_result, key):
+    """
+    Test that the image and mask slices are correctly converted into SimpleITK Images.
 
+    GIVEN: A valid image and mask.
+    WHEN: The function get_slices_2D is called.
+    THEN: The 'ImageSlice' and 'MaskSlice' in the returned data should be SimpleITK Images.
+    """
+    assert isinstance(slices_2d_result[0][key], sitk.Image), f"Expected '{key}' to be a SimpleITK Image."
 
-def test_get_slices_2D_mask_slice():
+
+def test_get_slices_2D_uses_opencv(monkeypatch, sample_3d_image_mask):
     """
-    Test that the mask slice is correctly converted into a SimpleITK Image.
+    Test that get_slices_2D labels the slices with OpenCV when it is installed and numba is not.
 
-    GIVEN: A valid image and mask.
+    GIVEN: OpenCV is available, numba is not, and a valid image and mask.
     WHEN: The function get_slices_2D is called.
-    THEN: The 'MaskSlice' in the returned data should be a SimpleITK Image.
+    THEN: Each non-empty slice should be labelled by OpenCV.
     """
-    image_array = np.random.rand(3, 4, 4)
-    mask_array = np.array([  # 3 slices
-        [[0, 1, 1, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[0, 0, 0, 0], [1, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[2, 2, 0, 0], [2, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
-    ])
-    image = sitk.GetImageFromArray(image_array)
-    mask = sitk.GetImageFromArray(mask_array)
-    patient_id = 1234
+    cv2 = pytest.importorskip("cv2")
+    calls = []
+    connected_components = cv2.connectedComponentsWithStats
+
+    def _counting(*args, **kwargs):
+        calls.append(args)
+        return connected_components(*args, **kwargs)
 
-    slices = get_slices_2D(image, mask, patient_id)
+    monkeypatch.setattr(cv2, "connectedComponentsWithStats", _counting)
+    monkeypatch.setattr("image_processing.largest_cc_label", None)
+    image, mask = sample_3d_image_mask
 
-    assert isinstance(slices[0]['MaskSlice'], sitk.Image), "Expected 'MaskSlice' to be a SimpleITK Image."
+    slices = get_slices_2D(image, mask, 1234)
 
+    assert len(calls) == len(slices) == 3, f"Expected 3 OpenCV calls, but got {len(calls)}."
 
-def test_get_slices_2D_labels():
+
+def test_get_slices_2D_scipy_backend(monkeypatch, sample_3d_image_mask, slices_2d_result):
     """
-    Test that the correct labels are assigned to the slices.
+    Test that the scipy labelling of get_slices_2D, used without numba and OpenCV, gives the same slices.
 
-    GIVEN: A valid image and mask.
+    GIVEN: numba and OpenCV are not available and a valid image and mask.
     WHEN: The function get_slices_2D is called.
-    THEN: The label should be correctly assigned to each slice.
+    THEN: The slices, labels and region masks should match those of the default backend.
     """
-    image_array = np.random.rand(3, 4, 4)
-    mask_array = np.array([  # 3 slices
-        [[0, 1, 1, 0], [0, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[0, 0, 0, 0], [1, 1, 1, 0], [0, 0, 0, 0], [0, 0, 0, 0]],
-        [[2, 2, 0, 0], [2, 2, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]
-    ])
-    image = sitk.GetImageFromArray(image_array)
-    mask = sitk.GetImageFromArray(mask_array)
-    patient_id = 1234
-    slices = get_slices_2D(image, mask, patient_id)
-    assert slices[0]['Label'] == 1, f"Expected label 1 for first slice, but got {slices[0]['Label']}."
+    monkeypatch.setattr("image_processing.largest_cc_label", None)
+    monkeypatch.setattr("image_processing.cv2", None)
+    image, mask = sample_3d_image_mask
+
+    slices = get_slices_2D(image, mask, 1234)
 
+    assert slices.indices.tolist() == slices_2d_result.indices.tolist(), "Slice indices differ between backends."
+    assert slices.labels.tolist() == slices_2d_result.labels.tolist(), "Labels differ between backends."
+    assert all(
+        _eq(sitk.GetArrayFromImage(scipy_mask), sitk.GetArrayFromImage(default_mask))
+        for scipy_mask, default_mask in zip(slices.masks, slices_2d_result.masks)
+    ), "Region masks differ between backends."
 
-def test_get_slices_2D_invalid_image_type():
+
+def test_get_slices_2D_invalid_image_type(sample_3d_image_mask):
     """
     Test that a TypeError is raised when the 'image' is not a SimpleITK Image.
 
@@ -409,8 +592,7 @@ def test_get_slices_2D_invalid_image_type():
     WHEN: The function get_slices_2D is called.
     THEN: A TypeError should be raised.
     """
-    mask_array = np.random.rand(3, 4, 4)
-    mask = sitk.GetImageFromArray(mask_array)
+    _, mask = sample_3d_image_mask
     patient_id = 1234
 
     with pytest.raises(TypeError, match="Expected 'image' to be a SimpleITK Image"):
@@ -423,10 +605,9 @@ def test_get_slices_2D_skip_slice_on_none():
     WHEN get_slices_2D is called
     THEN it should skip that slice and not include it in the results
     """
-    # Create a 3D image and mask where one slice will have no region
-    img = sitk.GetImageFromArray(np.random.rand(3, 10, 10))  # 3 slices
-    mask = sitk.GetImageFromArray(np.array([np.zeros((10, 10)), np.zeros((10, 10)), np.ones((10, 10))],
-                                           dtype=np.uint16))  # Only last slice has region
+    # Create a 3D image and a mask where every slice is non-empty, so process_slice is called on each of them
+    img = sitk.GetImageFromArray(np.zeros((3, 10, 10), dtype=np.float32))  # 3 slices
+    mask = sitk.GetImageFromArray(np.ones((3, 10, 10), dtype=np.uint16))
 
     # Mock patient ID
     patient_id = 123
@@ -439,7 +620,22 @@ def test_get_slices_2D_skip_slice_on_none():
     assert len(result) == 1, f"Expected 1 slice, but got {len(result)}"
 
 
-def test_invalid_mask_type():
+def test_get_slices_2D_skip_empty_slices():
+    """
+    GIVEN a mask where only the last slice contains a labeled region
+    WHEN get_slices_2D is called
+    THEN it should skip the empty slices and only return the last one
+    """
+    img = sitk.GetImageFromArray(np.zeros((3, 10, 10), dtype=np.float32))  # 3 slices
+    mask = sitk.GetImageFromArray(np.array([np.zeros((10, 10)), np.zeros((10, 10)), np.ones((10, 10))],
+                                           dtype=np.uint16))  # Only last slice has region
+
+    result = get_slices_2D(img, mask, 123)
+
+    assert [s['SliceIndex'] for s in result] == [2], f"Expected only slice 2, but got {result}"
+
+
+def test_invalid_mask_type(empty_sitk_10):
     """
     Test that the function raises a TypeError if the mask is not a SimpleITK Image.
 
@@ -447,14 +643,14 @@ def test_invalid_mask_type():
     WHEN: The get_slices_2D function is called.
     THEN: The function should raise a TypeError indicating the invalid mask type.
     """
-    valid_image = sitk.Image(10, 10, 10, sitk.sitkUInt8)  # Valid SimpleITK image
+    valid_image = empty_sitk_10  # Valid SimpleITK image
     invalid_mask = "invalid_mask"  # A string, not a SimpleITK Image
     patient_id = 1234
 
     with pytest.raises(TypeError, match="Expected 'mask' to be a SimpleITK Image"):
         get_slices_2D(valid_image, invalid_mask, patient_id)
 
-def test_invalid_patient_id_type():
+def test_invalid_patient_id_type(empty_sitk_10):
     """
     Test that the function raises a ValueError if the patient_id is not int.
 
@@ -462,62 +658,62 @@ def test_invalid_patient_id_type():
     WHEN: The get_slices_2D function is called.
     THEN: The function should raise a ValueError indicating the invalid patient_id type.
     """
-    valid_image = sitk.Image(10, 10, 10, sitk.sitkUInt8)  # Valid SimpleITK image
-    valid_mask = sitk.Image(10, 10, 10, sitk.sitkUInt8)  # Valid SimpleITK mask
+    valid_image = empty_sitk_10  # Valid SimpleITK image
+    valid_mask = empty_sitk_10  # Valid SimpleITK mask
     invalid_patient_id = '12345'  # Not a string
 
     with pytest.raises(ValueError, match="Expected 'patient_id' to be a int"):
         get_slices_2D(valid_image, valid_mask, invalid_patient_id)
 
 
-def test_get_volume_3D_return_type():
+def test_get_volume_3D_return_type(empty_sitk_10):
     """
     GIVEN: A 3D image and mask.
     WHEN: The get_volume_3D function is called.
     THEN: The function should return a list containing a dictionary with the correct keys.
     """
-    image_3d = sitk.Image(3, 3, 3, sitk.sitkUInt8)
-    mask_3d = sitk.Image(3, 3, 3, sitk.sitkUInt8)
+    image_3d = empty_sitk_10
+    mask_3d = empty_sitk_10
     patient_id = 1234
 
     result = get_volume_3D(image_3d, mask_3d, patient_id)
 
     assert isinstance(result, list), f"Expected result to be a list, but got {type(result)}."
 
-def test_get_volume_3D_invalid_image_type():
+def test_get_volume_3D_invalid_image_type(empty_sitk_10):
     """
     GIVEN: A non-SimpleITK image (e.g., a numpy array).
     WHEN: The get_volume_3D function is called.
     THEN: The function should raise a TypeError indicating that the image is not of type SimpleITK.Image.
     """
-    invalid_image = np.array([[1, 2], [3, 4]])
-    mask_3d = sitk.Image(3, 3, 3, sitk.sitkUInt8)
+    invalid_image = np.array([[1, 2], [3, 4]], dtype=np.int8)
+    mask_3d = empty_sitk_10
     patient_id = 1234
 
     with pytest.raises(TypeError, match="Expected 'image' to be a SimpleITK Image"):
         get_volume_3D(invalid_image, mask_3d, patient_id)
 
-def test_get_volume_3D_invalid_image_type():
+def test_get_volume_3D_invalid_image_type(empty_sitk_10):
     """
     GIVEN: A non-SimpleITK image (e.g., a numpy array).
     WHEN: The get_volume_3D function is called.
     THEN: The function should raise a TypeError indicating that the image is not of type SimpleITK.Image.
     """
-    invalid_image = np.array([[1, 2], [3, 4]])
-    mask_3d = sitk.Image(3, 3, 3, sitk.sitkUInt8)
+    invalid_image = np.array([[1, 2], [3, 4]], dtype=np.int8)
+    mask_3d = empty_sitk_10
     patient_id = 1234
 
     with pytest.raises(TypeError, match="Expected 'image' to be a SimpleITK Image"):
         get_volume_3D(invalid_image, mask_3d, patient_id)
 
-def test_get_volume_3D_invalid_patient_id():
+def test_get_volume_3D_invalid_patient_id(empty_sitk_10):
     """
     GIVEN: A string patient_id.
     WHEN: The get_volume_3D function is called.
     THEN: The function should raise a ValueError indicating that patient_id must be int.
     """
-    image_3d = sitk.Image(3, 3, 3, sitk.sitkUInt8)
-    mask_3d = sitk.Image(3, 3, 3, sitk.sitkUInt8)
+    image_3d = empty_sitk_10
+    mask_3d = empty_sitk_10
     patient_id = '123'
 
     with pytest.raises(ValueError, match="Expected 'patient_id' to be a int"):
@@ -572,7 +768,7 @@ def test_get_patient_image_mask_dict_invalid_mode(mock_read_image):
         get_patient_image_mask_dict(imgs_path, masks_path, patient_ids, mode)
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def mock_read_image_and_mask():
     """Mock function to replace read_image_and_mask."""
 
@@ -584,7 +780,7 @@ def mock_read_image_and_mask():
     return _mock
 
 
-@pytest.fixture
+@pytest.fixture(scope="module")
 def sample_data():
     """Fixture providing sample input data."""
     return {
@@ -592,6 +788,7 @@ def sample_data():
         "masks_path": ["mask1.nii", "mask2.nii"],
         "patient_ids": [1, 2],
         "mode": "3D",
+        "max_workers": 1,  # Mocked readers are not visible from worker processes
     }
 
 
@@ -612,59 +809,116 @@ def test_get_patient_image_mask_dict_patient_count(monkeypatch, mock_read_image_
     assert len(result) == 2, f"Expected 2 patients, but got {len(result)}"
 
 
-def test_get_patient_image_mask_dict_3D_mask_type(monkeypatch, mock_read_image_and_mask, sample_data):
+@pytest.mark.parametrize("key", ['ImageVolume', 'MaskVolume'])
+def test_get_patient_image_mask_dict_3D_type(monkeypatch, mock_read_image_and_mask, sample_data, key):
     """
     GIVEN: A valid list of 3D images and masks with patient IDs.
     WHEN: The function is called in 3D mode.
-    THEN: The masks in the output dictionary should be instances of SimpleITK Image.
+    THEN: The image and mask in the output dictionary should be instances of SimpleITK Image.
     """
     monkeypatch.setattr("image_processing.read_image_and_mask", mock_read_image_and_mask)
 
     result = get_patient_image_mask_dict(**sample_data)
 
     for patient_id in sample_data["patient_ids"]:
-        assert isinstance(result[patient_id][0]['MaskVolume'], sitk.Image), "Mask should be a SimpleITK image."
+        assert isinstance(result[patient_id][0][key], sitk.Image), f"{key} should be a SimpleITK image."
 
 
-def test_get_patient_image_mask_dict_3D_mask_dimension(monkeypatch, mock_read_image_and_mask, sample_data):
+@pytest.mark.parametrize("key", ['ImageVolume', 'MaskVolume'])
+def test_get_patient_image_mask_dict_3D_dimension(monkeypatch, mock_read_image_and_mask, sample_data, key):
     """
     GIVEN: A valid list of 3D images and masks with patient IDs.
     WHEN: The function is called in 3D mode.
-    THEN: The masks in the output dictionary should have 3 dimensions.
+    THEN: The image and mask in the output dictionary should have 3 dimensions.
     """
     monkeypatch.setattr("image_processing.read_image_and_mask", mock_read_image_and_mask)
 
     result = get_patient_image_mask_dict(**sample_data)
 
     for patient_id in sample_data["patient_ids"]:
-        assert result[patient_id][0]['MaskVolume'].GetDimension() == 3, "Mask should be 3D in 3D mode."
+        assert result[patient_id][0][key].GetDimension() == 3, f"{key} should be 3D in 3D mode."
 
-def test_get_patient_image_mask_dict_3D_img_type(monkeypatch, mock_read_image_and_mask, sample_data):
+
+def test_get_patient_image_mask_dict_process_pool(tmp_path):
     """
-    GIVEN: A valid list of 3D images and masks with patient IDs.
-    WHEN: The function is called in 3D mode.
-    THEN: The image in the output dictionary should be instances of SimpleITK Image.
+    GIVEN: Two patients with image and mask files on disk.
+    WHEN: The function is called in 2D mode with two worker processes.
+    THEN: The slices of each patient should be returned under its patient ID.
     """
-    monkeypatch.setattr("image_processing.read_image_and_mask", mock_read_image_and_mask)
+    mask_array = np.zeros((3, 4, 4), dtype=np.uint8)
+    mask_array[1, 1:3, 1:3] = 1
+    imgs_path, masks_path = [], []
+    for pr_id in (1, 2):
+        img_path, mask_path = str(tmp_path / f"PR{pr_id}.nii"), str(tmp_path / f"PR{pr_id}_seg.nii")
+        sitk.WriteImage(sitk.GetImageFromArray(np.zeros((3, 4, 4), dtype=np.float32)), img_path)
+        sitk.WriteImage(sitk.GetImageFromArray(mask_array), mask_path)
+        imgs_path.append(img_path)
+        masks_path.append(mask_path)
 
-    result = get_patient_image_mask_dict(**sample_data)
+    result = get_patient_image_mask_dict(imgs_path, masks_path, [1, 2], "2D", max_workers=2)
 
-    for patient_id in sample_data["patient_ids"]:
-        assert isinstance(result[patient_id][0]['ImageVolume'], sitk.Image), "Image should be a SimpleITK image."
+    assert {pr_id: [s['SliceIndex'] for s in slices] for pr_id, slices in result.items()} == {1: [1], 2: [1]}, \
+        f"Unexpected slices {result}"
+
+
+def test_iter_patient_image_mask_3D_threads(monkeypatch, mock_read_image_and_mask, sample_data):
+    """
+    GIVEN: A valid list of 3D images and masks with patient IDs, and two workers.
+    WHEN: The iter_patient_image_mask function is called in 3D mode.
+    THEN: The patients should be read in worker threads, without starting worker processes.
+    """
+    threads = []
+
+    def _thread_recording_mock(img_path, mask_path):
+        threads.append(threading.current_thread())
+        return mock_read_image_and_mask(img_path, mask_path)
+
+    def _no_processes(*args, **kwargs):
+        raise AssertionError("3D patients should not be sent to worker processes")
+
+    monkeypatch.setattr("image_processing.read_image_and_mask", _thread_recording_mock)
+    monkeypatch.setattr("image_processing.ProcessPoolExecutor", _no_processes)
+
+    result = dict(iter_patient_image_mask(**{**sample_data, "max_workers": 2}))
 
+    assert list(result) == sample_data["patient_ids"], f"Unexpected patients {list(result)}"
+    assert threading.main_thread() not in threads, "Patients should be read in worker threads."
 
-def test_get_patient_image_mask_dict_3D_img_dimension(monkeypatch, mock_read_image_and_mask, sample_data):
+
+def test_iter_patient_image_mask_lazy(monkeypatch, mock_read_image_and_mask, sample_data):
     """
     GIVEN: A valid list of 3D images and masks with patient IDs.
-    WHEN: The function is called in 3D mode.
-    THEN: The image in the output dictionary should have 3 dimensions.
+    WHEN: The iter_patient_image_mask function is called.
+    THEN: The patients should be read one at a time, only when the iterator is consumed.
     """
-    monkeypatch.setattr("image_processing.read_image_and_mask", mock_read_image_and_mask)
+    reads = []
 
-    result = get_patient_image_mask_dict(**sample_data)
+    def _counting_mock(img_path, mask_path):
+        reads.append(img_path)
+        return mock_read_image_and_mask(img_path, mask_path)
 
-    for patient_id in sample_data["patient_ids"]:
-        assert result[patient_id][0]['ImageVolume'].GetDimension() == 3, "Image should be 3D in 3D mode."
+    monkeypatch.setattr("image_processing.read_image_and_mask", _counting_mock)
+
+    patients = iter_patient_image_mask(**sample_data)
+    first_id, _ = next(patients)
+
+    assert (first_id, reads) == (1, ["img1.nii"]), f"Expected only patient 1 to be read, but got {reads}"
+
+
+def test_iter_patient_image_mask_directory_mismatch(monkeypatch):
+    """
+    GIVEN: A list of image and mask paths where one mask is not in the directory of its image.
+    WHEN: The iter_patient_image_mask function is called.
+    THEN: It should raise a ValueError before reading any file.
+    """
+    def _fail(img_path, mask_path):
+        raise AssertionError(f"{img_path} was read")
+
+    monkeypatch.setattr("image_processing.read_image_and_mask", _fail)
+
+    with pytest.raises(ValueError, match="Image and mask must be in the same directory."):
+        iter_patient_image_mask(["a/PR1.nii", "b/PR2.nii"], ["a/PR1_seg.nii", "c/PR2_seg.nii"], [1, 2], "3D",
+                                max_workers=1)
 
 
 def test_read_image_and_mask_empty_path():
@@ -709,3 +963,25 @@ def test_read_image_and_mask_dimension_mismatch(mock_read_image_and_mask_differe
 
     with pytest.raises(ValueError, match="Image and mask dimensions do not match."):
         read_image_and_mask("image.nii", "mask.nii")
+
+
+@pytest.mark.parametrize("labels, expected_pixel_id", [
+    ([0, 1, 2], sitk.sitkUInt8),
+    ([0, 1, 300], sitk.sitkInt16),
+])
+def test_read_image_and_mask_narrows_mask(tmp_path, labels, expected_pixel_id):
+    """
+    GIVEN: A mask stored as int16.
+    WHEN: The read_image_and_mask function is called.
+    THEN: The mask should be returned as uint8 only if all its labels fit in it, with unchanged values.
+    """
+    img_path, mask_path = str(tmp_path / "PR1.nii"), str(tmp_path / "PR1_seg.nii")
+    mask_array = np.zeros((3, 3, 3), dtype=np.int16)
+    mask_array[0, 0, :] = labels
+    sitk.WriteImage(sitk.Image(3, 3, 3, sitk.sitkFloat32), img_path)
+    sitk.WriteImage(sitk.GetImageFromArray(mask_array), mask_path)
+
+    _, mask = read_image_and_mask(img_path, mask_path)
+
+    assert mask.GetPixelID() == expected_pixel_id, f"Expected pixel type {expected_pixel_id}, got {mask.GetPixelID()}"
+    assert np.array_equal(sitk.GetArrayFromImage(mask), mask_array), "Mask labels changed while narrowing."
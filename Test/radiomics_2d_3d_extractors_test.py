@@ -1,7 +1,9 @@
+import sys
 import logging
 import pytest
 from radiomics import featureextractor
 from radiomics_2d_3d_extractors import *
+from image_processing import SlicesBatch
 import numpy as np
 import SimpleITK as sitk
 from unittest.mock import Mock
@@ -35,6 +37,77 @@ def test_get_extractor_file_not_found():
         get_extractor("non_existent.yaml")
 
 
+@pytest.fixture
+def mock_extractor_class(monkeypatch):
+    """Replace RadiomicsFeatureExtractor with a mock recording the settings it is built with."""
+    extractor_class = Mock()
+    monkeypatch.setattr(featureextractor, "RadiomicsFeatureExtractor", extractor_class, raising=False)
+    return extractor_class
+
+
+@pytest.fixture
+def yaml_file(tmp_path):
+    """Empty extractor configuration file."""
+    path = tmp_path / "config.yaml"
+    path.write_text("")
+    return str(path)
+
+
+def _fake_gpu_modules(monkeypatch, cuda_available):
+    """Install fake torch and torchradiomics modules and return the mocked inject_torch_radiomics."""
+    torch = Mock()
+    torch.cuda.is_available.return_value = cuda_available
+    torchradiomics = Mock()
+    monkeypatch.setitem(sys.modules, "torch", torch)
+    monkeypatch.setitem(sys.modules, "torchradiomics", torchradiomics)
+    return torch, torchradiomics.inject_torch_radiomics
+
+
+def test_get_extractor_gpu_without_torchradiomics(monkeypatch, caplog, mock_extractor_class, yaml_file):
+    """
+    GIVEN torchradiomics is not installed
+    WHEN get_extractor is called with use_gpu=True
+    THEN it should log a warning and build the CPU extractor.
+    """
+    monkeypatch.setitem(sys.modules, "torchradiomics", None)
+
+    with caplog.at_level(logging.WARNING):
+        get_extractor(yaml_file, use_gpu=True)
+
+    mock_extractor_class.assert_called_once_with(yaml_file)
+    assert "torchradiomics is not installed" in caplog.text
+
+
+def test_get_extractor_gpu_without_cuda(monkeypatch, caplog, mock_extractor_class, yaml_file):
+    """
+    GIVEN torchradiomics is installed but CUDA is not available
+    WHEN get_extractor is called with use_gpu=True
+    THEN it should log a warning, leave the pyradiomics classes in place and build the CPU extractor.
+    """
+    _, inject = _fake_gpu_modules(monkeypatch, cuda_available=False)
+
+    with caplog.at_level(logging.WARNING):
+        get_extractor(yaml_file, use_gpu=True)
+
+    mock_extractor_class.assert_called_once_with(yaml_file)
+    inject.assert_not_called()
+    assert "CUDA is not available" in caplog.text
+
+
+def test_get_extractor_gpu(monkeypatch, mock_extractor_class, yaml_file):
+    """
+    GIVEN torchradiomics is installed and CUDA is available
+    WHEN get_extractor is called with use_gpu=True
+    THEN it should inject the torch feature classes and build the extractor on the GPU.
+    """
+    torch, inject = _fake_gpu_modules(monkeypatch, cuda_available=True)
+
+    get_extractor(yaml_file, use_gpu=True)
+
+    inject.assert_called_once_with()
+    mock_extractor_class.assert_called_once_with(yaml_file, dtype=torch.float32, device="cuda:0")
+
+
 def test_radiomic_extractor_3D_empty_labels():
     """
     GIVEN a patient_dict_3D with an empty mask (no labels)
@@ -42,7 +115,7 @@ def test_radiomic_extractor_3D_empty_labels():
     THEN it should raise a ValueError indicating no labels in the mask
     """
     # Mock data for the patient (SimpleITK Image objects)
-    img_1 = sitk.GetImageFromArray(np.random.rand(10, 10, 10))
+    img_1 = sitk.GetImageFromArray(np.empty((10, 10, 10), dtype=np.float32))
     mask_1 = sitk.GetImageFromArray(np.zeros((10, 10, 10)))
 
     # Mock patient_dict_3D with SimpleITK images
@@ -65,7 +138,7 @@ def test_radiomic_extractor_3D_logging_error(caplog):
     THEN it should log an error message
     """
     # Mock data: image and mask with label 1
-    img = sitk.GetImageFromArray(np.random.rand(10, 10, 10))
+    img = sitk.GetImageFromArray(np.empty((10, 10, 10), dtype=np.float32))
     mask = sitk.GetImageFromArray(np.full((10, 10, 10), fill_value=2, dtype=np.uint16))
 
     # Patient mock dictionary
@@ -97,7 +170,7 @@ def test_radiomic_extractor_3D_valid_input_patient_key():
     THEN it should return a dictionary with the expected patient key
     """
     # Mock data for the patient (SimpleITK Image objects)
-    img_1 = sitk.GetImageFromArray(np.random.rand(10, 10, 10))
+    img_1 = sitk.GetImageFromArray(np.empty((10, 10, 10), dtype=np.float32))
     mask_1 = sitk.GetImageFromArray(np.full((10, 10, 10), fill_value=1, dtype=np.uint16))  # Assuming this will result in a label of 1
 
     # Mock patient_dict_3D with SimpleITK images
@@ -123,7 +196,7 @@ def test_radiomic_extractor_3D_valid_input_feature1():
     THEN it should return the correct value for Feature1
     """
     # Mock data for the patient (SimpleITK Image objects)
-    img_1 = sitk.GetImageFromArray(np.random.rand(10, 10, 10))
+    img_1 = sitk.GetImageFromArray(np.empty((10, 10, 10), dtype=np.float32))
     mask_1 = sitk.GetImageFromArray(np.full((10, 10, 10), fill_value=1, dtype=np.uint16))  # Assuming this will result in a label of 1
 
     # Mock patient_dict_3D with SimpleITK images
@@ -149,7 +222,7 @@ def test_radiomic_extractor_3D_valid_input_feature2():
     THEN it should return the correct value for Feature2
     """
     # Mock data for the patient (SimpleITK Image objects)
-    img_1 = sitk.GetImageFromArray(np.random.rand(10, 10, 10))
+    img_1 = sitk.GetImageFromArray(np.empty((10, 10, 10), dtype=np.float32))
     mask_1 = sitk.GetImageFromArray(np.full((10, 10, 10), fill_value=1, dtype=np.uint16))  # Assuming this will result in a label of 1
 
     # Mock patient_dict_3D with SimpleITK images
@@ -176,7 +249,7 @@ def test_radiomic_extractor_2D_empty_labels():
     THEN it should raise a ValueError indicating no labels in the mask
     """
     # Mock data for the patient (SimpleITK Image objects)
-    img_1 = sitk.GetImageFromArray(np.random.rand(10, 10, 10))
+    img_1 = sitk.GetImageFromArray(np.empty((10, 10, 10), dtype=np.float32))
     mask_1 = sitk.GetImageFromArray(np.zeros((10, 10, 10)))
 
     # Mock patient_dict_2D with SimpleITK images
@@ -199,7 +272,7 @@ def test_radiomic_extractor_2D_logging_error(caplog):
     THEN it should log an error message
     """
     # Create mock 2D image and mask
-    img = sitk.GetImageFromArray(np.random.rand(10, 10))
+    img = sitk.GetImageFromArray(np.empty((10, 10), dtype=np.float32))
     mask = sitk.GetImageFromArray(np.full((10, 10), fill_value=2, dtype=np.uint16))  # Assuming label 2
 
     # Patient mock dictionary
@@ -229,7 +302,7 @@ def test_radiomic_extractor_2D_valid_input_patient_key():
     THEN it should return a dictionary with the expected patient key
     """
     # Mock data for the patient (SimpleITK Image objects)
-    img_1 = sitk.GetImageFromArray(np.random.rand(10, 10))
+    img_1 = sitk.GetImageFromArray(np.empty((10, 10), dtype=np.float32))
     mask_1 = sitk.GetImageFromArray(np.full((10, 10), fill_value=1, dtype=np.uint16))  # Label 1
 
     # Mock patient_dict_2D with SimpleITK images
@@ -255,7 +328,7 @@ def test_radiomic_extractor_2D_valid_input_feature1():
     THEN it should return the correct value for Feature1
     """
     # Mock data for the patient (SimpleITK Image objects)
-    img_1 = sitk.GetImageFromArray(np.random.rand(10, 10))
+    img_1 = sitk.GetImageFromArray(np.empty((10, 10), dtype=np.float32))
     mask_1 = sitk.GetImageFromArray(np.full((10, 10), fill_value=1, dtype=np.uint16))  # Label 1
 
     # Mock patient_dict_2D with SimpleITK images
@@ -281,7 +354,7 @@ def test_radiomic_extractor_2D_valid_input_feature2():
     THEN it should return the correct value for Feature2
     """
     # Mock data for the patient (SimpleITK Image objects)
-    img_1 = sitk.GetImageFromArray(np.random.rand(10, 10))
+    img_1 = sitk.GetImageFromArray(np.empty((10, 10), dtype=np.float32))
     mask_1 = sitk.GetImageFromArray(np.full((10, 10), fill_value=1, dtype=np.uint16))  # Label 1
 
     # Mock patient_dict_2D with SimpleITK images
@@ -300,6 +373,72 @@ def test_radiomic_extractor_2D_valid_input_feature2():
     assert result["123-0-1"]["Feature2"] == 0.8
 
 
+def test_radiomic_extractor_2D_slices_batch():
+    """
+    GIVEN a patient_dict_2D holding a SlicesBatch
+    WHEN radiomic_extractor_2D is called
+    THEN it should pass the SimpleITK slices to the extractor and return the features under the slice key
+    """
+    batch = SlicesBatch(
+        patient_id="PR123",
+        indices=np.array([4]),
+        labels=np.array([1]),
+        images=[sitk.GetImageFromArray(np.empty((10, 10), dtype=np.float32))],
+        masks=[sitk.GetImageFromArray(np.ones((10, 10), dtype=np.uint8))]
+    )
+    patient_dict_2D = {123: batch}
+
+    extractor = Mock()
+    extractor.execute.return_value = {"Feature1": 0.5}
+
+    result = radiomic_extractor_2D(patient_dict_2D, extractor)
+
+    img_slice, mask_slice = extractor.execute.call_args.args
+    assert isinstance(img_slice, sitk.Image) and isinstance(mask_slice, sitk.Image)
+    assert result["123-4-1"]["Feature1"] == 0.5
+
+
+def test_radiomic_extractor_2D_several_patients_failing_slice():
+    """
+    GIVEN a patient_dict_2D with several patients and slices, one of which fails extraction
+    WHEN radiomic_extractor_2D is called
+    THEN each key should hold the features of its own slice, and the failing slice should be skipped
+    """
+    img = sitk.GetImageFromArray(np.empty((10, 10), dtype=np.float32))
+    mask = sitk.GetImageFromArray(np.ones((10, 10), dtype=np.uint8))
+
+    patient_dict_2D = {
+        123: [{"ImageSlice": img, "MaskSlice": mask, "Label": lbl, "SliceIndex": index}
+              for index, lbl in [(0, 1), (1, 2), (2, 1)]],
+        456: SlicesBatch(
+            patient_id="PR456",
+            indices=np.array([3, 5]),
+            labels=np.array([3, 1]),
+            images=[img, img],
+            masks=[mask, mask]
+        ),
+    }
+
+    # Each call returns a feature identifying its slice, and the third call fails
+    calls = iter([(123, 0, 1), (123, 1, 2), None, (456, 3, 3), (456, 5, 1)])
+
+    def _execute(img_slice, mask_slice, label):
+        call = next(calls)
+        if call is None:
+            raise Exception("Test Exception")
+        return {"Call": call}
+
+    extractor = Mock()
+    extractor.execute.side_effect = _execute
+
+    result = radiomic_extractor_2D(patient_dict_2D, extractor)
+
+    assert list(result) == ["123-0-1", "123-1-2", "456-3-3", "456-5-1"]
+    for key, features in result.items():
+        assert features["Call"] == (features["PatientID"], features["SliceIndex"], features["MaskLabel"])
+        assert key == "{}-{}-{}".format(*features["Call"])
+
+
 # Dummy extractor for testing purposes
 class DummyExtractor:
     def execute(self, patient_dict):
@@ -1,6 +1,6 @@
 import pytest
 import SimpleITK as sitk
-from utils import get_path_images_masks, extract_id, new_patient_id, assign_patient_ids
+from utils import get_path_images_masks, extract_id, new_patient_id, assign_patient_ids, get_max_workers
 
 
 @pytest.fixture
@@ -453,3 +453,28 @@ def test_assign_patient_ids_invalid_id_format():
 
     # Assert new patient IDs are assigned correctly
     assert patient_ids == {1, 2}, f" Expected new patient IDs {1, 2}, but got {patient_ids} "
+
+
+def test_get_max_workers_env(monkeypatch):
+    """
+    Test that the number of workers is read from the environment when not given.
+
+    GIVEN: The RADIOMICS_MAX_WORKERS environment variable set to 3.
+    WHEN: The get_max_workers function is called without arguments.
+    THEN: The function returns 3.
+    """
+    monkeypatch.setenv("RADIOMICS_MAX_WORKERS", "3")
+
+    assert get_max_workers() == 3, f"Expected 3 workers, but got {get_max_workers()}"
+
+
+def test_get_max_workers_invalid():
+    """
+    Test that the function raises an error for a non-positive number of workers.
+
+    GIVEN: A number of workers equal to 0.
+    WHEN: The get_max_workers function is called.
+    THEN: The function raises a ValueError.
+    """
+    with pytest.raises(ValueError, match="The number of workers must be at least 1"):
+        get_max_workers(0)
@@ -1,14 +1,75 @@
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
+from collections import deque
+from dataclasses import dataclass
 import numpy as np
 import SimpleITK as sitk
-from scipy.ndimage import label
+from scipy.ndimage import label, generate_binary_structure
+from utils import get_max_workers
 
-def extract_largest_region(mask_slice, label_value):
+# Optional numba kernel for the single-label largest region search, used when numba is installed
+try:
+    from image_processing_nb import largest_cc_label
+except ImportError:
+    largest_cc_label = None
+
+# Optional OpenCV connected components, which also return the area of each component
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+# 2D structuring element (4-connectivity), built once instead of on every label() call
+_STRUCT2D = generate_binary_structure(2, 1)
+
+
+@dataclass(eq=False)
+class SlicesBatch:
+    """
+    2D slices of a patient stored as a structure of arrays: one entry per slice in every field.
+
+    Indexing or iterating a batch gives the per-slice dictionaries
+    {'PatientID', 'Label', 'SliceIndex', 'ImageSlice', 'MaskSlice'} for backward compatibility.
+    """
+    patient_id: str
+    indices: np.ndarray
+    labels: np.ndarray
+    images: list
+    masks: list
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        return {
+            'PatientID': self.patient_id,
+            'Label': int(self.labels[i]),
+            'SliceIndex': int(self.indices[i]),
+            'ImageSlice': self.images[i],
+            'MaskSlice': self.masks[i]
+        }
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def iter_columns(self):
+        """
+        Iterate the slices column-wise, without building the per-slice dictionaries.
+
+        :return: Iterator of (label, slice_index, image_slice, mask_slice) tuples, with SimpleITK slices.
+        """
+        for lbl, index, image_slice, mask_slice in zip(self.labels, self.indices, self.images, self.masks):
+            yield int(lbl), int(index), image_slice, mask_slice
+
+
+def extract_largest_region(mask_slice, label_value, out=None):
     """
     Extract the largest connected region of a given label from a binary mask slice.
 
     :param mask_slice: 2D numpy array representing the mask slice
     :param label_value: Integer label to extract the largest region from
+    :param out: Optional preallocated 2D numpy array, with the shape of mask_slice, where the result is written
     :return: 2D numpy array containing only the largest connected region of the given label
     """
 
@@ -22,50 +83,142 @@ def extract_largest_region(mask_slice, label_value):
     if label_value < 0:
         raise ValueError("Label value cannot be negative")
 
+    if out is None:
+        out = np.empty_like(mask_slice)
+
+    return out if _largest_region(mask_slice, label_value, out) else None
+
+
+def _largest_region(mask_slice, label_value, out):
+    """
+    Write the largest connected region of a given label into out, without validating the inputs.
+
+    :param mask_slice: 2D numpy array representing the mask slice
+    :param label_value: Non-negative integer label to extract the largest region from
+    :param out: 2D numpy array, with the shape of mask_slice, where the region is written (label_value, else 0)
+    :return: Area of the region in pixels, 0 if the label is absent (out is then left untouched)
+    """
+
+    if largest_cc_label is not None:
+        return int(largest_cc_label(mask_slice, label_value, out))
+
     # Create a binary mask for the specified label
     region_mask = (mask_slice == label_value)
 
-    # Label the connected components in the binary mask
-    labeled_region, num_labels = label(region_mask)
+    # Label the connected components in the binary mask, with the area of each of them
+    if cv2 is not None:
+        _, labeled_region, stats, _ = cv2.connectedComponentsWithStats(
+            region_mask.view(np.uint8), connectivity=4, ltype=cv2.CV_32S)
+        areas = stats[:, cv2.CC_STAT_AREA]
+    else:
+        labeled_region, _ = label(region_mask, structure=_STRUCT2D)
+        areas = np.bincount(labeled_region.ravel())
 
-    largest_region = None
-    largest_area = 0
+    # Largest component, ignoring the background (0)
+    areas[0] = 0
+    largest_id = areas.argmax()
+    if areas[largest_id] == 0:
+        return 0
 
-    # Iterate through all connected components, ignoring the background (0)
-    for region_id in range(1, num_labels + 1):
-        region = (labeled_region == region_id).astype(mask_slice.dtype) * label_value
-        region_area = np.sum(region > 0)
+    np.multiply(labeled_region == largest_id, label_value, out=out, casting='unsafe')
 
-        # Update the largest region if the current one is bigger
-        if region_area > largest_area:
-            largest_area = region_area
-            largest_region = region
+    return int(areas[largest_id])
 
-    return largest_region
 
+def _largest_single_label_region(mask_slice, label_counts, out):
+    """
+    Write the largest connected region of a single label into out, searching each candidate label separately.
+
+    Labels are visited by decreasing pixel count, and the search stops as soon as a label has fewer pixels
+    than the largest region found: on most slices only the first label has to be labelled.
 
-def process_slice(mask_slice):
+    :param mask_slice: 2D numpy array representing the mask slice
+    :param label_counts: 1D numpy array with the number of pixels of each label in mask_slice (index 0 ignored)
+    :param out: 2D numpy array, with the shape of mask_slice, where the region is written (its label, else 0)
+    :return: Label of the region, or None if the slice is empty. Ties between equally large regions go to
+             the smaller label.
     """
-    Process a mask slice to extract the largest connected region for each label.
+
+    best_area, best_label = 0, None
+    # Each candidate is written into the buffer that does not hold the best region so far
+    best_buffer, spare_buffer = None, None
+
+    # Stable sort: labels with the same pixel count are visited from the smallest one
+    for lbl in np.argsort(-label_counts[1:], kind="stable") + 1:
+        lbl = int(lbl)
+        count = label_counts[lbl]
+        if count == 0 or count < best_area:
+            break
+        if count == best_area and lbl > best_label:
+            continue
+
+        if best_buffer is None:
+            candidate_buffer = out
+        else:
+            if spare_buffer is None:
+                spare_buffer = np.empty_like(out)
+            candidate_buffer = spare_buffer
+        area = _largest_region(mask_slice, lbl, candidate_buffer)
+
+        if area > best_area or (area == best_area and lbl < best_label):
+            best_area, best_label = area, lbl
+            spare_buffer, best_buffer = best_buffer, candidate_buffer
+
+    if best_buffer is not None and best_buffer is not out:
+        np.copyto(out, best_buffer)
+
+    return best_label
+
+
+def process_slice(mask_slice, out=None):
+    """
+    Process a mask slice to extract the largest connected region among all labels.
+
+    The selected region is the largest 4-connected region made of a single label. Ties between equally
+    large regions go to the smaller label, then to the first region in raster order.
 
     :param mask_slice: 2D numpy array representing the mask slice
-    :return: Tuple (largest_region_mask, label) of the largest region found
-    :raises ValueError: If the mask has no labeled regions
+    :param out: Optional preallocated 2D numpy array, with the shape of mask_slice, where the region mask is written
+    :return: Tuple (largest_region_mask, label) of the largest region found, or (None, None) if the slice is empty.
+             Without out, the region mask has the narrowest unsigned integer type that holds the labels of the slice.
     """
 
-    labels = np.unique(mask_slice)
-    labels = labels[labels != 0]  # Exclude background
+    # Empty slices need no labelling: any() stops at the first non-zero pixel
+    if not mask_slice.any():
+        return None, None
+
+    # Pixel count of every label of the slice, which bounds the area of its regions. Single-label slices,
+    # detected from the extremes of the labeled pixels, skip the bincount
+    labeled_values = mask_slice[mask_slice != 0]
+    lo, hi = int(labeled_values.min()), int(labeled_values.max())
+    if lo == hi:
+        label_counts = np.zeros(hi + 1, dtype=np.intp)
+        label_counts[hi] = labeled_values.size
+    else:
+        label_counts = np.bincount(labeled_values.astype(np.intp, copy=False))
 
-    for lbl in labels:
-        lbl = int(lbl)  # Convert numpy.int16 to native Python int
-        largest_region_mask = extract_largest_region(mask_slice, lbl)
-        if largest_region_mask is not None:
-            return largest_region_mask, lbl
-    # If no region found
-    return None, None
+    # The output only has to hold 0 and a label: use the narrowest integer type able to (uint8 below 256)
+    if out is None:
+        out = np.empty(mask_slice.shape, dtype=np.min_scalar_type(hi))
+
+    lbl = _largest_single_label_region(mask_slice, label_counts, out)
+    if lbl is None:
+        return None, None
+
+    return out, lbl
 
 
 def get_slices_2D(image, mask, patient_id):
+    """
+    Extract, from each slice of a 3D mask, the largest connected region together with its image slice.
+
+    :param image: 3D SimpleITK Image.
+    :param mask: 3D SimpleITK Image with the segmentation labels.
+    :param patient_id: Integer patient ID.
+    :return: SlicesBatch with one entry per slice that contains a labeled region.
+    :raises TypeError: If image or mask are not SimpleITK Images.
+    :raises ValueError: If patient_id is not an integer.
+    """
 
     if not isinstance(image, sitk.Image):
         raise TypeError(f"Expected 'image' to be a SimpleITK Image, but got {type(image)}.")
@@ -77,28 +230,43 @@ def get_slices_2D(image, mask, patient_id):
     if not isinstance(patient_id, int):
         raise ValueError(f"Expected 'patient_id' to be a int, but got {type(patient_id)}.")
 
-    image_array = sitk.GetArrayFromImage(image)
-    mask_array = sitk.GetArrayFromImage(mask)
-    patient_slices = []
+    # Read-only, zero-copy view of the mask buffer: mask stays alive for the whole function
+    mask_array = sitk.GetArrayViewFromImage(mask)
+    slice_indices, slice_labels, image_slices, mask_slices = [], [], [], []
 
-    for slice_idx in range(mask_array.shape[0]):
+    # Image slices are cut directly from the SimpleITK volume, without a numpy round-trip
+    extract_size = list(image.GetSize())
+    extract_size[2] = 0
+
+    # Region masks are written into one buffer reused across slices (GetImageFromArray copies it)
+    region_buffer = np.empty(mask_array.shape[1:], dtype=np.min_scalar_type(int(mask_array.max())))
+
+    # Only visit the slices that contain at least one labeled pixel
+    non_empty = mask_array.reshape(mask_array.shape[0], -1).any(axis=1)
+
+    for slice_idx in np.flatnonzero(non_empty):
+        slice_idx = int(slice_idx)
         mask_slice = mask_array[slice_idx, :, :]
-        image_slice = image_array[slice_idx, :, :]
 
-        region_mask, region_label = process_slice(mask_slice)
+        region_mask, region_label = process_slice(mask_slice, out=region_buffer)
         if region_mask is None:
             continue
-        largest_region_mask_image  = sitk.GetImageFromArray(region_mask)
-        image_slice_image = sitk.GetImageFromArray(image_slice)
-        patient_slices.append({
-            'PatientID': f"PR{patient_id}",
-            'Label': region_label,
-            'SliceIndex': slice_idx,
-            'ImageSlice':  image_slice_image,
-            'MaskSlice': largest_region_mask_image
-        })
-
-    return patient_slices
+        image_slice_image = sitk.Extract(image, extract_size, [0, 0, slice_idx],
+                                         sitk.ExtractImageFilter.DIRECTIONCOLLAPSETOIDENTITY)
+        largest_region_mask_image = sitk.GetImageFromArray(region_mask)
+        largest_region_mask_image.CopyInformation(image_slice_image)
+        slice_indices.append(slice_idx)
+        slice_labels.append(region_label)
+        image_slices.append(image_slice_image)
+        mask_slices.append(largest_region_mask_image)
+
+    return SlicesBatch(
+        patient_id=f"PR{patient_id}",
+        indices=np.array(slice_indices, dtype=np.intp),
+        labels=np.array(slice_labels, dtype=np.int64),
+        images=image_slices,
+        masks=mask_slices
+    )
 
 
 def get_volume_3D(image, mask, patient_id):
@@ -126,10 +294,10 @@ def read_image_and_mask(image_path, mask_path):
 
     :param image_path: Path to the image file.
     :param mask_path: Path to the mask file.
-    :return: Tuple containing the image and mask as SimpleITK images.
+    :return: Tuple containing the image and mask as SimpleITK images. Integer masks whose labels fit in
+             0-255 are returned as uint8.
     :raises ValueError: If any of the input paths is empty.
     :raises TypeError: If the input paths are not strings.
-    :raises ValueError: If the parent directories of the image and mask do not match.
     :raises ValueError: If the image and mask dimensions do not match.
     """
 
@@ -139,38 +307,110 @@ def read_image_and_mask(image_path, mask_path):
     if not isinstance(image_path, str) or not isinstance(mask_path, str):
         raise TypeError("Image and mask paths must be strings.")
 
-    if os.path.dirname(image_path) != os.path.dirname(mask_path):
-        raise ValueError("Image and mask must be in the same directory.")
-
     img = sitk.ReadImage(image_path)
     mask = sitk.ReadImage(mask_path)
 
     if img.GetSize() != mask.GetSize():
         raise ValueError("Image and mask dimensions do not match.")
 
+    # Masks are often stored as 16/32-bit integers: narrow them to uint8 when the labels fit, so that every
+    # later comparison against a label value moves less memory
+    if mask.GetPixelID() not in (sitk.sitkUInt8, sitk.sitkUInt16):
+        mask_array = sitk.GetArrayViewFromImage(mask)
+        if np.issubdtype(mask_array.dtype, np.integer) and mask_array.min() >= 0 and mask_array.max() < 256:
+            mask = sitk.Cast(mask, sitk.sitkUInt8)
+
     return img, mask
 
 
 
-def get_patient_image_mask_dict(imgs_path, masks_path, patient_ids, mode):
+def _process_one(pr_id, img_path, mask_path, mode):
+    """
+    Read the image and mask of one patient and split them according to the mode.
+
+    :param pr_id: Integer patient ID.
+    :param img_path: Path to the image file.
+    :param mask_path: Path to the mask file.
+    :param mode: '2D' or '3D'.
+    :return: Tuple (pr_id, entries) with the slices (2D) or the volume (3D) of the patient.
+    """
+    img, mask = read_image_and_mask(img_path, mask_path)
+
+    if mode == "2D":
+        return pr_id, get_slices_2D(img, mask, pr_id)
+    return pr_id, get_volume_3D(img, mask, pr_id)
+
+
+def iter_patient_image_mask(imgs_path, masks_path, patient_ids, mode, max_workers=None):
+    """
+    Read the images and masks of the patients one at a time, so that each can be processed and discarded
+    before the next ones are loaded. In 2D mode patients are read and sliced in parallel worker processes;
+    in 3D mode, where reading the files is all the work, they are read in parallel threads.
+
+    :param imgs_path: List of paths to the image files.
+    :param masks_path: List of paths to the mask files.
+    :param patient_ids: Patient IDs, in the same order as the paths.
+    :param mode: '2D' or '3D'.
+    :param max_workers: Number of worker processes (2D) or threads (3D). Defaults to the RADIOMICS_MAX_WORKERS
+                        environment variable, or to the number of CPUs. With 1 worker patients are processed
+                        in the calling thread.
+    :return: Iterator of (pr_id, entries) tuples with the slices (2D) or the volume (3D) of each patient,
+             in the order of patient_ids.
+    :raises ValueError: If patient_ids is empty, if the list lengths differ, if the mode is invalid or if an
+                        image and its mask are not in the same directory.
+    """
     if len(patient_ids) == 0:
         raise ValueError("The patient_ids list cannot be empty.")
 
     if len(imgs_path) != len(masks_path) or len(imgs_path) != len(patient_ids):
         raise ValueError("The number of images, masks, and patient_ids must be the same.")
 
-    patient_dict = {}
+    if mode not in ("2D", "3D"):
+        raise ValueError("Mode should be '2D' or '3D'")
+
+    # Check all the path pairs at once, so that a mismatch fails before any volume is read
+    if list(map(os.path.dirname, imgs_path)) != list(map(os.path.dirname, masks_path)):
+        raise ValueError("Image and mask must be in the same directory.")
 
-    for pr_id, img_path, mask_path in zip(patient_ids, imgs_path, masks_path):
-        img, mask = read_image_and_mask(img_path, mask_path)
+    max_workers = min(get_max_workers(max_workers), len(patient_ids))
 
-        if mode == "2D":
-            patient_slices = get_slices_2D(img, mask, pr_id)
-            patient_dict[pr_id] = patient_slices
-        elif mode == "3D":
-            patient_volume = get_volume_3D(img, mask, pr_id)
-            patient_dict[pr_id] = patient_volume
-        else:
-            raise ValueError("Mode should be '2D' or '3D'")
+    if max_workers <= 1:
+        return map(_process_one, patient_ids, imgs_path, masks_path, repeat(mode))
+    return _iter_parallel(imgs_path, masks_path, patient_ids, mode, max_workers)
 
-    return patient_dict
\ No newline at end of file
+
+def _iter_parallel(imgs_path, masks_path, patient_ids, mode, max_workers):
+    """
+    Process the patients in parallel workers, keeping at most max_workers + 1 of them in flight or
+    waiting to be consumed.
+
+    Slicing a 2D patient is CPU-bound Python work, run in processes. A 3D patient is only read by
+    SimpleITK, which releases the GIL: threads avoid pickling both volumes back to the caller.
+
+    :return: Iterator of (pr_id, entries) tuples, in the order of patient_ids.
+    """
+    executor_class = ProcessPoolExecutor if mode == "2D" else ThreadPoolExecutor
+    with executor_class(max_workers=max_workers) as executor:
+        pending = deque()
+        for pr_id, img_path, mask_path in zip(patient_ids, imgs_path, masks_path):
+            pending.append(executor.submit(_process_one, pr_id, img_path, mask_path, mode))
+            if len(pending) > max_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_patient_image_mask_dict(imgs_path, masks_path, patient_ids, mode, max_workers=None):
+    """
+    Read the images and masks of all patients and build the per-patient dictionary.
+
+    :param imgs_path: List of paths to the image files.
+    :param masks_path: List of paths to the mask files.
+    :param patient_ids: Patient IDs, in the same order as the paths.
+    :param mode: '2D' or '3D'.
+    :param max_workers: Number of worker processes, see iter_patient_image_mask.
+    :return: Dictionary mapping each patient ID to its slices (2D) or volume (3D).
+    :raises ValueError: If patient_ids is empty, if the list lengths differ, if the mode is invalid or if an
+                        image and its mask are not in the same directory.
+    """
+    return dict(iter_patient_image_mask(imgs_path, masks_path, patient_ids, mode, max_workers))
@@ -0,0 +1,86 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def _find_root(parent, node):
+    """
+    Find the root of a provisional label in the union-find forest, compressing the path on the way.
+
+    :param parent: 1D int32 numpy array with the parent of each provisional label
+    :param node: Provisional label
+    :return: Root label of node
+    """
+    root = node
+    while parent[root] != root:
+        root = parent[root]
+    while parent[node] != root:
+        next_node = parent[node]
+        parent[node] = root
+        node = next_node
+    return root
+
+
+@njit(cache=True)
+def largest_cc_label(mask_slice, label_value, out):
+    """
+    Write the largest 4-connected region of a given label into out, with a two-pass union-find labelling.
+
+    Components are numbered in raster order of their first pixel, as scipy.ndimage.label does, so ties
+    between equally large regions are broken the same way.
+
+    :param mask_slice: 2D numpy array representing the mask slice
+    :param label_value: Integer label to extract the largest region from
+    :param out: 2D numpy array, with the shape of mask_slice, where the region is written (label_value, else 0)
+    :return: Area of the region in pixels, 0 if the label is not in the mask slice (out is then left untouched)
+    """
+    rows, cols = mask_slice.shape
+    labels = np.zeros((rows, cols), dtype=np.int32)
+    parent = np.zeros(rows * cols + 1, dtype=np.int32)
+    areas = np.zeros(rows * cols + 1, dtype=np.int64)
+    next_label = 1
+
+    # First pass: provisional labels from the upper and left neighbours, recording their equivalences
+    # (a root is always the smallest label of its tree) and the area of each provisional label
+    for r in range(rows):
+        for c in range(cols):
+            if mask_slice[r, c] != label_value:
+                continue
+            up = labels[r - 1, c] if r > 0 else 0
+            left = labels[r, c - 1] if c > 0 else 0
+            if up == 0 and left == 0:
+                current = next_label
+                parent[current] = current
+                next_label += 1
+            elif up == 0 or left == 0:
+                current = up + left
+            else:
+                root_up = _find_root(parent, up)
+                root_left = _find_root(parent, left)
+                current = min(root_up, root_left)
+                parent[root_up] = current
+                parent[root_left] = current
+            labels[r, c] = current
+            areas[current] += 1
+
+    if next_label == 1:
+        return 0
+
+    # Resolve every provisional label to its root in increasing order (parents are smaller than their
+    # children) and move the areas onto the roots, each named after the first pixel of its component
+    for provisional in range(1, next_label):
+        root = parent[parent[provisional]]
+        parent[provisional] = root
+        if root != provisional:
+            areas[root] += areas[provisional]
+            areas[provisional] = 0
+
+    largest_id = np.argmax(areas[:next_label])
+    largest_area = areas[largest_id]
+
+    # Second pass: write the largest component
+    for r in range(rows):
+        for c in range(cols):
+            out[r, c] = label_value if parent[labels[r, c]] == largest_id else 0
+
+    return largest_area
@@ -2,44 +2,62 @@ import os
 import pandas as pd
 import configparser
 import utils
-from image_processing import get_patient_image_mask_dict
+from image_processing import iter_patient_image_mask
 from radiomics_2d_3d_extractors import get_extractor, extract_radiomic_features
 
-# Read the configuration .ini file
-config = configparser.ConfigParser()
-config.read("config.ini")
 
-data_path = config["paths"]["data_path"]
-output_path = config["paths"]["output_path"]
-mode = config["settings"]["mode"]
-extractor_config = config["settings"]["extractor_config"]
+def main():
+    """
+    Run the radiomic feature extraction configured in config.ini and save the features to a CSV file.
+    """
+    # Read the configuration .ini file
+    config = configparser.ConfigParser()
+    config.read("config.ini")
 
-# Ensure the output directory exists
-os.makedirs(output_path, exist_ok=True)
+    data_path = config["paths"]["data_path"]
+    output_path = config["paths"]["output_path"]
+    mode = config["settings"]["mode"]
+    extractor_config = config["settings"]["extractor_config"]
+    use_gpu = config["settings"].getboolean("use_gpu", fallback=False)
 
-# Get image and mask paths
-images_path, masks_path = utils.get_path_images_masks(data_path)
-patient_ids = utils.assign_patient_ids(images_path)
+    # Ensure the output directory exists
+    os.makedirs(output_path, exist_ok=True)
 
-# Create patient dictionary
-patient_dict = get_patient_image_mask_dict(images_path, masks_path, patient_ids, mode)
+    # Get image and mask paths
+    images_path, masks_path = utils.get_path_images_masks(data_path)
+    patient_ids = utils.assign_patient_ids(images_path)
 
-# Create extractor
-extractor = get_extractor(extractor_config)
+    # Create extractor
+    extractor = get_extractor(extractor_config, use_gpu)
 
-# Extract radiomic features
-radiomic_dictionary = extract_radiomic_features(patient_dict, extractor, mode)
+    output_file = os.path.join(output_path, f"{mode}_Radiomic_Features.csv")
+    index_column = 'PatientID - Slice - Label' if mode == "2D" else 'PatientID - Label'
+    columns = None
 
-# Convert to DataFrame and save
-radiomic_dataframe = pd.DataFrame(radiomic_dictionary).T.reset_index()
+    # Extract radiomic features one patient at a time, appending them to the output file,
+    # so that only the patients being processed are kept in memory
+    for pr_id, patient_entries in iter_patient_image_mask(images_path, masks_path, patient_ids, mode):
+        radiomic_dictionary = extract_radiomic_features({pr_id: patient_entries}, extractor, mode)
+        if not radiomic_dictionary:
+            continue
 
-# Rename columns based on mode
-if mode == "2D":
-    radiomic_dataframe.rename(columns={'index': 'PatientID - Slice - Label'}, inplace=True)
-else:
-    radiomic_dataframe.rename(columns={'index': 'PatientID - Label'}, inplace=True)
+        # Convert to DataFrame and save
+        radiomic_dataframe = pd.DataFrame(radiomic_dictionary).T.reset_index()
+        radiomic_dataframe.rename(columns={'index': index_column}, inplace=True)
 
-output_file = os.path.join(output_path, f"{mode}_Radiomic_Features.csv")
-radiomic_dataframe.to_csv(output_file, sep=",", header=True, index=False)
+        if columns is None:
+            columns = radiomic_dataframe.columns
+            radiomic_dataframe.to_csv(output_file, sep=",", header=True, index=False)
+        else:
+            radiomic_dataframe.reindex(columns=columns).to_csv(output_file, mode="a", sep=",", header=False, index=False)
 
-print(f"Feature extraction completed successfully! Results saved in {output_file}")
+    if columns is None:
+        pd.DataFrame(columns=[index_column]).to_csv(output_file, sep=",", header=True, index=False)
+
+    print(f"Feature extraction completed successfully! Results saved in {output_file}")
+
+
+# Patients are processed in worker processes: with the spawn and forkserver start methods every worker
+# imports this module, which must then not run the extraction again
+if __name__ == "__main__":
+    main()
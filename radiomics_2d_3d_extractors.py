@@ -3,14 +3,19 @@ import numpy as np
 import SimpleITK as sitk
 import logging
 from radiomics import featureextractor
+from image_processing import SlicesBatch
 
 
-def get_extractor(yaml_path):
+def get_extractor(yaml_path, use_gpu=False):
     """
     Creates a RadiomicsFeatureExtractor with a specified configuration file.
 
     Args:
         yaml_path (str): Path to the YAML file containing configuration parameters.
+        use_gpu (bool): If True, compute the features on the GPU through torchradiomics.
+            Falls back to the CPU extractor if torchradiomics or CUDA are not available. Defaults to False.
+            The GPU backend replaces the pyradiomics feature classes for the whole process, and is not
+            undone: extractors created afterwards also use it, even with use_gpu=False.
 
     Returns:
         extractor: Configured RadiomicsFeatureExtractor object.
@@ -29,13 +34,41 @@ def get_extractor(yaml_path):
     if not os.path.isfile(yaml_path):
         raise FileNotFoundError(f"The file '{yaml_path}' does not exist.")
 
-    extractor = featureextractor.RadiomicsFeatureExtractor(yaml_path)
+    extractor_settings = _gpu_settings() if use_gpu else {}
+    extractor = featureextractor.RadiomicsFeatureExtractor(yaml_path, **extractor_settings)
     # Configure logging for Pyradiomics
     logger = logging.getLogger('radiomics')  # Check log messages given by pyradiomics
     logger.setLevel(logging.ERROR)
 
     return extractor
 
+
+def _gpu_settings():
+    """
+    Replaces the pyradiomics feature classes with the torchradiomics ones, computed on the GPU.
+
+    pyradiomics looks the feature classes up when the features are computed, so they cannot be restored
+    once the extractor is built: the replacement is process-wide and one-way.
+
+    Returns:
+        dict: Extra extractor settings selecting the torch device and dtype, empty if the GPU
+            backend is not available (the CPU pyradiomics classes are then left in place).
+    """
+    try:
+        import torch
+        from torchradiomics import inject_torch_radiomics
+    except ImportError:
+        logging.warning("torchradiomics is not installed: falling back to CPU feature extraction.")
+        return {}
+
+    if not torch.cuda.is_available():
+        logging.warning("CUDA is not available: falling back to CPU feature extraction.")
+        return {}
+
+    inject_torch_radiomics()
+    return {"dtype": torch.float32, "device": "cuda:0"}
+
+
 def radiomic_extractor_3D(patient_dict_3D, extractor):
     """
     Extracts radiomic features from 3D medical images.
@@ -53,23 +86,30 @@ def radiomic_extractor_3D(patient_dict_3D, extractor):
         patient_volume = patient_data[0]
         img = patient_volume["ImageVolume"]
         mask = patient_volume["MaskVolume"]
-        # Convert SimpleITK Image to NumPy array for processing
-        mask_array = sitk.GetArrayFromImage(mask)
-
-        # Get unique labels, excluding 0 (background label)
-        labels = np.unique(mask_array)[1:]
-        # labels = np.unique(mask)[1:]
+        # Zero-copy NumPy view of the SimpleITK mask, only read to find the labels
+        mask_array = sitk.GetArrayViewFromImage(mask)
 
-        if len(labels) == 0:
+        # Get the labels present in the mask, excluding 0 (background label), with a linear
+        # bincount instead of the sort done by np.unique
+        max_label = int(mask_array.max())
+        if max_label <= 0:
             raise ValueError(f"No labels found in mask for patient {pr_id}")
 
+        # bincount works on intp values: count one slice at a time, so that only a slice is widened
+        # to 8 bytes per voxel instead of the whole volume
+        label_counts = np.zeros(max_label + 1, dtype=np.intp)
+        for mask_slice in mask_array.reshape(mask_array.shape[0], -1):
+            label_counts += np.bincount(mask_slice.astype(np.intp, copy=False), minlength=max_label + 1)
+        labels = np.flatnonzero(label_counts[1:]) + 1
+
+        pr_key = f"PR{pr_id}"
         for lbl in labels:
             try:
                 features = extractor.execute(img, mask, label=int(lbl))
                 features = {"MaskLabel": lbl, "PatientID": pr_id, **features}
-                all_features[f"PR{pr_id} - {lbl:d}"] = features
+                all_features[f"{pr_key} - {lbl:d}"] = features
             except Exception as e:
-                logging.error(f"[Invalid Feature] for patient PR{pr_id}, label {lbl}: {e}")
+                logging.error(f"[Invalid Feature] for patient {pr_key}, label {lbl}: {e}")
 
     return all_features
 
@@ -80,7 +120,8 @@ def radiomic_extractor_2D(patient_dict_2D, extractor):
     Extracts radiomic features from 2D medical image slices.
 
     Args:
-        patient_dict_2D (dict): Dictionary containing patient 2D slices.
+        patient_dict_2D (dict): Dictionary containing patient 2D slices, either as SlicesBatch
+            objects or as lists of per-slice dictionaries.
         extractor: Configured RadiomicsFeatureExtractor object.
 
     Returns:
@@ -88,27 +129,30 @@ def radiomic_extractor_2D(patient_dict_2D, extractor):
     """
     all_features_2D = {}
 
+    # Slices are extracted one at a time: the pyradiomics C extensions hold the GIL, so threads
+    # would not run them in parallel, and patients are already read and sliced in worker processes
     for patient_id, patient_slices in patient_dict_2D.items():
-        for slice_data in patient_slices:
-            lbl = slice_data["Label"]
-            index = slice_data["SliceIndex"]
-
+        if isinstance(patient_slices, SlicesBatch):
+            slices = patient_slices.iter_columns()
+        else:
+            slices = ((slice_data["Label"], slice_data["SliceIndex"], slice_data["ImageSlice"],
+                       slice_data["MaskSlice"]) for slice_data in patient_slices)
+
+        # The patient part of the feature keys is formatted once per patient, not once per slice
+        key_prefix = f"{patient_id}-"
+        for lbl, index, img_slice, mask_slice in slices:
             if lbl == 0:
                 raise ValueError(f"No labels found in mask for patient {patient_id}")
-
             try:
-                img_slice = slice_data["ImageSlice"]
-                mask_slice = slice_data["MaskSlice"]
-
                 features = extractor.execute(img_slice, mask_slice, label=int(lbl))
-
-                features = {"MaskLabel": lbl, "SliceIndex": index, "PatientID": patient_id, **features}
-                key = f"{patient_id}-{index}-{lbl}"
-                all_features_2D[key] = features
-                # Debug log to check if the key is being added
-                logging.debug(f"Added features for {key}: {features}")
             except Exception as e:
                 logging.error(f"[Invalid Feature] for patient {patient_id}, Slice {index}, Label {lbl}: {e}")
+                continue
+            key = f"{key_prefix}{index}-{lbl}"
+            all_features_2D[key] = {"MaskLabel": lbl, "SliceIndex": index, "PatientID": patient_id, **features}
+            # Debug log to check if the key is being added
+            logging.debug(f"Added features for {key}: {all_features_2D[key]}")
+
     return all_features_2D
 
 
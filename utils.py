@@ -111,6 +111,24 @@ def assign_patient_ids(images_path):
     return patient_ids
 
 
+def get_max_workers(max_workers=None):
+    """
+    Get the number of parallel workers to use.
+
+    :param max_workers: Requested number of workers. If None, the RADIOMICS_MAX_WORKERS environment variable
+                        is used, or the number of CPUs if it is not set.
+    :return: Number of workers, at least 1.
+    :raises ValueError: If the number of workers is not a positive integer.
+    """
+    if max_workers is None:
+        max_workers = os.environ.get("RADIOMICS_MAX_WORKERS", os.cpu_count() or 1)
 
+    try:
+        max_workers = int(max_workers)
+    except ValueError:
+        raise ValueError(f"The number of workers must be an integer, but got '{max_workers}'")
 
+    if max_workers < 1:
+        raise ValueError("The number of workers must be at least 1")
 
+    return max_workers